@@ -1,20 +1,68 @@
-#! /usr/bin/python
+#! /usr/bin/env python3
 import git
 from git import Repo
 from git import Git
-from ftplib import FTP
+from ftplib import FTP, FTP_TLS, error_perm, all_errors
 import os
+import shutil
+import socket
+import ssl
+import tarfile
+import tempfile
 import sys
 import io
+import functools
 import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, fall back to plain lock files there
+    fcntl = None
 
 
+# Most targets handled at once when connecting, checking or deploying. Each
+# thread holds an open connection, on top of any extra upload connections.
+MAX_TARGET_THREADS = 32
+
+# gitpython talks to a single long running git process, which isn't thread safe
+_repo_lock = threading.Lock()
+
+# Resolve a commit id to a commit object. Several targets are usually on the
+# same commit, so remember the result rather than asking git each time.
+@functools.lru_cache(maxsize=128)
+def resolve_commit(repo, commit_id):
+    with _repo_lock:
+        return repo.commit(commit_id)
+
+# Split NUL separated git output (from a -z option) into its fields
+def split_nul(output):
+    return [field for field in output.split("\x00") if field]
+
 def check_dirs_configured(config, locked_dirs, repo):
-    # for each target target_dir - check they are configured to work with this tool
+    # for each target target_dir - check they are configured to work with this tool.
+    # Each has its own connection, so fetch all the commit files at once
+    errors = []
+    def _check_dir(target_dir):
+        # any failure (unreadable file, unknown commit) just marks this dir invalid,
+        # so every bad dir gets reported and every locked dir gets unlocked
+        try:
+            return target_dir.check_valid_commit(repo)
+        except Exception as e:
+            errors.append(target_dir.path + ": " + str(e))
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_TARGET_THREADS, len(config.dirs)))) as executor:
+        valid = list(executor.map(_check_dir, config.dirs))
+    for error in errors:
+        print (error)
+    
     dirs_missing_commit = []
-    for target_dir in config.dirs:
+    for target_dir, is_valid in zip(config.dirs, valid):
         # if no such file exists (or commit is gibberish) add to list of dirs without .commit files
-        if not target_dir.check_valid_commit(repo):
+        if not is_valid:
             dirs_missing_commit.append(target_dir)
     
     # if any dirs lack .git_commit files abort with error listing incorrect dirs
@@ -48,26 +96,37 @@ def lock_dirs(config):
     already_locked_dirs = []
     cannot_lock = []
            
-    # for each target target_dir - check that they aren't already locked
-    for target_dir in config.dirs:
-        # connect
+    results_lock = threading.Lock()
+
+    # connect to and lock a single target_dir, recording the outcome. Any error
+    # counts as unable to lock, so the abort below still unlocks the others
+    def _lock_dir(target_dir):
         try :
+            # connect
             target_dir.connect()
-        except Exception as e:
-            cannot_lock.append(target_dir)
-            print (e.message)
-            continue
-        
-        # check for lock file
-        if target_dir.check_locked():
-            already_locked_dirs.append(target_dir)
-        else:
-            # if not already locked, do so and track which dirs are "locked"
-            if target_dir.lock():
-                locked_dirs.append(target_dir)
+
+            # check for lock file
+            if target_dir.check_locked():
+                with results_lock:
+                    already_locked_dirs.append(target_dir)
             else:
+                # if not already locked, do so and track which dirs are "locked"
+                if target_dir.lock():
+                    with results_lock:
+                        locked_dirs.append(target_dir)
+                else:
+                    with results_lock:
+                        cannot_lock.append(target_dir)
+        except Exception as e:
+            with results_lock:
                 cannot_lock.append(target_dir)
-        
+            print (target_dir.path + ": " + str(e))
+
+    # for each target target_dir - check that they aren't already locked.
+    # Each directory owns its own connection, so they can be handled in parallel
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_TARGET_THREADS, len(config.dirs)))) as executor:
+        list(executor.map(_lock_dir, config.dirs))
+
     # If any lock files already existed, abort with error
     if len(already_locked_dirs) > 0:
         message = "Unable to lock the following target directories:\n"
@@ -91,83 +150,217 @@ class Config_Details:
         # should contain at minimum:
         # path of local git Repo (ideally absolute path, TBD)
         # list of directories to deploy to
-            # <optional> mode of access (default=Normal, FTP also supported)
+            # <optional> mode of access (default=Normal, FTP and FTPS also supported)
             # <optional> connection authentication details
+            # <optional> remote_untar - upload full deploys as one archive and unpack
+            #            it with SITE EXEC tar (FTP servers that allow it only)
+            # <optional> verify_tls - for FTPS, check the server's certificate and
+            #            host name against the system CA store (default=true). Only
+            #            set false for servers with self-signed certificates; without
+            #            verification anyone in between can read the credentials.
+        # <optional> number of connections to use per target when uploading (default=1)
       
         config_file = open(config_filename, "r")
         config = json.load(config_file)
         
         errors = []
-        if "path" in config.keys():
-            self.path = config["path"]
-        else: 
+        self.path = config.get("path")
+        if self.path is None:
             errors.append("path is missing")
             
         self.dirs = []
-        if "targets" in config.keys():
-            for item in config["targets"]:
-                if "path" in item.keys():
-                    self.dirs.append(Directory(item["path"], item.get("mode"), item.get("auth")))
+        targets = config.get("targets")
+        if targets is None:
+            errors.append("targets are missing") 
+        else:
+            for item in targets:
+                path = item.get("path")
+                if path is not None:
+                    self.dirs.append(Directory(path, item.get("mode"), item.get("auth"),
+                                               item.get("remote_untar", False),
+                                               item.get("verify_tls", True)))
                 else:
                     errors.append("path missing")
-        else:
-            errors.append("targets are missing") 
+            
+        self.concurrency = config.get("concurrency", 1)
+        if not isinstance(self.concurrency, int) or self.concurrency < 1:
+            errors.append("concurrency must be a positive integer")
             
         config_file.close()
         if len(errors) > 0:
             raise IOError("Parse errors : " + ",".join(errors))       
         
+# FTP over TLS, where data connections resume the control connection's TLS
+# session instead of each negotiating a new one. Saves a full handshake per
+# transfer, and many servers refuse data connections that don't do this.
+class Session_Reuse_FTP_TLS(FTP_TLS):
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn,
+                                            server_hostname=self.host,
+                                            session=self.sock.session)
+        return conn, size
+
 # Represents a directory we are deploying to
 class Directory:
+    __slots__ = ('path', 'remote_untar', 'verify_tls', 'buffer', 'connection_mode',
+                 'commit', 'auth', 'handle', '_current_cwd', '_mkdir_cache', '_lock_fd')
+    
+    FTP_MODES = ("FTP", "FTPS")
     LOCK_FILE = ".git_lock"
     COMMIT_FILE = ".git_commit" 
+    DEPLOY_ARCHIVE = ".git_deploy.tar"
+    # Block size for FTP uploads. ftplib defaults to 8KB; larger blocks mean far
+    # fewer trips between python and the socket for each file.
+    UPLOAD_BLOCKSIZE = 1024 * 1024
     
-    def __init__(self, path, connection_mode = None, auth = None):
+    def __init__(self, path, connection_mode = None, auth = None, remote_untar = False,
+                 verify_tls = True):
         self.path = path
-        self.buffer = ""
+        self.remote_untar = remote_untar
+        self.verify_tls = verify_tls
+        self.buffer = bytearray()
         self.connection_mode = None
         self.commit = None
-        
-        # Callback for use in some remote read operations     
-        def _read_to_buffer(data):
-            self.buffer += data
-        self.read_to_buffer = _read_to_buffer
+        self.handle = None
+        # remote working directory, tracked to avoid redundant CWD commands
+        self._current_cwd = None
+        # directories we have already created or found, so we don't check again
+        self._mkdir_cache = set()
+        # open lock file descriptor while we hold an flock on a local target
+        self._lock_fd = None
         
         if connection_mode is not None:
             # should just be a string, make comparissons case insensitive
             self.connection_mode = connection_mode.upper()
             self.auth = auth
     
+    # Callback for use in some remote read operations     
+    def _read_to_buffer(self, data):
+        self.buffer.extend(data)
+    
     # Makes the connection (if any needed) to the destination directory. 
     # Throws an exception if unable to connect for some reason.
     def connect(self):
         if self.connection_mode is None:
             return
         
-        #supported modes : FTP (TODO support more, e.g. SSH, SFTP)
-        if self.connection_mode == "FTP":
-            if "host" not in self.auth.keys():
+        #supported modes : FTP, FTPS (TODO support more, e.g. SSH, SFTP)
+        if self.connection_mode in self.FTP_MODES:
+            if "host" not in self.auth:
                 print ("No host")
                 raise Exception("Unable to connect via FTP without a host")
             
-            if "user" in self.auth.keys() and "password" in self.auth.keys():
+            if "user" in self.auth and "password" in self.auth:
                 print ("Username and password specified")
-                # This logs in automatically
-                self.handle = FTP(self.auth['host'],
-                                  self.auth['user'], 
-                                  self.auth['password'])
-                print ("Logged in")
             else:
                 print ("No username or password")
-                self.handle = FTP(self.auth['host'])
-                self.handle.login()     
+            self.handle = self._open_ftp()
+            self._current_cwd = None
+            print ("Logged in")
         else:
             raise Exception("Unsupported connection mode: " + self.connection_mode)        
     
+    # Opens and logs in a new FTP connection using this directory's auth details
+    def _open_ftp(self):
+        ftp_class = FTP
+        options = {}
+        if self.connection_mode == "FTPS":
+            ftp_class = Session_Reuse_FTP_TLS
+            # ftplib's own default context doesn't check certificates at all
+            context = ssl.create_default_context()
+            if not self.verify_tls:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            options["context"] = context
+        if "user" in self.auth and "password" in self.auth:
+            # This logs in automatically
+            handle = ftp_class(self.auth['host'],
+                               self.auth['user'], 
+                               self.auth['password'],
+                               **options)
+        else:
+            handle = ftp_class(self.auth['host'], **options)
+            handle.login()
+        if self.connection_mode == "FTPS":
+            # encrypt the data connections too, not just the login
+            handle.prot_p()
+        # the connection is held from locking through to the end of the deploy,
+        # so keep it alive while we work on other targets / local git
+        handle.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return handle
+    
+    # Creates a copy of this directory with its own connection, so uploads can
+    # be spread over several connections to the same target
+    def _spawn_worker(self):
+        worker = Directory(self.path, self.connection_mode, self.auth,
+                           verify_tls=self.verify_tls)
+        worker.handle = self._open_ftp()
+        try:
+            worker._cwd(self.path)
+        except all_errors:
+            worker.close()
+            raise
+        return worker
+    
+    # Changes the remote working directory, skipping the round trip if we are
+    # already there. The cached value is dropped if the change fails.
+    def _cwd(self, path):
+        path = path.rstrip("/") or "/"
+        if self._current_cwd == path:
+            return
+        self._current_cwd = None
+        self.handle.cwd(path)
+        self._current_cwd = path
+    
+    # Changes into a remote directory, creating it and any missing parents first
+    # if it doesn't exist yet
+    def _cwd_or_mkd(self, path):
+        path = path.rstrip("/") or "/"
+        if path in self._mkdir_cache:
+            self._cwd(path)
+            return
+        try:
+            self._cwd(path)
+        except error_perm:
+            parent = os.path.dirname(path)
+            if parent != path:
+                self._cwd_or_mkd(parent)
+            try:
+                self.handle.mkd(path)
+            except error_perm:
+                # another connection to this target may have just created it,
+                # in which case changing into it below will still succeed
+                pass
+            self._cwd(path)
+        self._mkdir_cache.add(path)
+    
     def check_locked(self):
+        if self.connection_mode is None and fcntl is not None:
+            return self._check_locked_local()
         # check for lock file
         return self._check_file_exists(self.LOCK_FILE)
     
+    # A local lock file only counts while some deploy still holds its flock. The
+    # kernel drops the flock when a process dies, so a lock file left behind by a
+    # crashed deploy doesn't block the directory forever.
+    def _check_locked_local(self):
+        if self._lock_fd is not None:
+            return True
+        try:
+            fd = os.open(os.path.join(self.path, self.LOCK_FILE), os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            # closing also releases the flock if we got it
+            os.close(fd)
+        return False
+    
     # check for the existence of a single file
     def _check_file_exists(self, filename):
         # How we check depends on what connection we have to the filesystem
@@ -175,8 +368,16 @@ class Directory:
             # just a normal directory
             if os.path.exists(os.path.join(self.path, filename )):
                 return True
-        elif self.connection_mode == "FTP":
-            self.handle.cwd(self.path)
+        elif self.connection_mode in self.FTP_MODES:
+            self._cwd(self.path)
+            # ask about the single file first, rather than listing the directory
+            try:
+                self.handle.voidcmd("MLST " + filename)
+                return True
+            except error_perm as e:
+                # only fall back to a listing if the server doesn't know MLST
+                if not str(e).startswith(("500", "502")):
+                    return False
             for path_details in self.handle.mlsd():
                 if path_details[0] == filename:
                     return True
@@ -190,11 +391,11 @@ class Directory:
             for line in file_handle:
                 contents += line
             file_handle.close()
-        elif self.connection_mode == "FTP":
-            self.buffer = ""
-            self.handle.cwd(self.path)
+        elif self.connection_mode in self.FTP_MODES:
+            self.buffer.clear()
+            self._cwd(self.path)
             self.handle.retrbinary('RETR ' + filename, self._read_to_buffer)
-            contents = self.buffer
+            contents = self.buffer.decode("utf-8")
         return contents[:-1]
     
     def check_valid_commit(self, repo):
@@ -204,18 +405,52 @@ class Directory:
 
         # make sure recorded commit is valid
         commit_id = self._read_root_dir_file_contents(self.COMMIT_FILE)
-        self.commit = repo.commit(commit_id) 
+        self.commit = resolve_commit(repo, commit_id) 
         return self.commit and self.commit.__class__ is git.Commit
     
     def lock(self):
+        if self.connection_mode is None and fcntl is not None:
+            return self._lock_local()
         try:
             #write a lock file to the directory - return boolean indicating success
             self.write_new_file(self.LOCK_FILE, "locked")
         except IOError as e:
-            print ("Unable to write file: " + e.message)
+            print ("Unable to write file: " + str(e))
             return False
         return True
     
+    # Takes an flock on the lock file of a local target, so two deploys can't
+    # both pass check_locked and then lock the same directory
+    def _lock_local(self):
+        path = os.path.join(self.path, self.LOCK_FILE)
+        fd = None
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # another deploy may have unlocked and removed the file between our
+            # open and flock, in which case we've locked a file nobody can see
+            if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                raise IOError("Lock file was replaced: " + path)
+            os.write(fd, b"locked")
+        except (IOError, OSError) as e:
+            print ("Unable to lock directory: " + str(e))
+            if fd is not None:
+                os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+    
+    # Releases the lock taken by lock()
+    def unlock(self):
+        if self._lock_fd is None:
+            self.delete_file(self.LOCK_FILE)
+            return
+        # remove the file before releasing it, so nobody can lock it in between
+        os.remove(os.path.join(self.path, self.LOCK_FILE))
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        os.close(self._lock_fd)
+        self._lock_fd = None
+    
     def write_new_file(self, filename, contents):
         print (self.connection_mode)
         if self.connection_mode is None:
@@ -223,48 +458,64 @@ class Directory:
             w = open(path, "w")
             w.write(contents)    
             w.close()
-        elif self.connection_mode == "FTP":
+        elif self.connection_mode in self.FTP_MODES:
+            if isinstance(contents, str):
+                contents = contents.encode("utf-8")
             in_stream = io.BytesIO(contents)
             path = os.path.join(self.path, os.path.dirname(filename))
             print(self.path)
-            try:
-                self.handle.cwd(self.path)
-            except IOError as e:
-                print ("Error : " + e.message)
-                self.handle.mkd(path)
-                self.handle.cwd(path)
-            self.handle.storbinary('STOR ' + os.path.basename(filename), in_stream)
+            self._cwd_or_mkd(path)
+            self.handle.storbinary('STOR ' + os.path.basename(filename), in_stream,
+                                   blocksize=self.UPLOAD_BLOCKSIZE)
             in_stream.close()
             
     def copy_file(self, filename, source_file):
         if self.connection_mode is None:
             path = os.path.join(self.path, filename)
             dirname = os.path.dirname(path)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            w = open(path, "wb")
-            f = open(source_file, "rb")
-            for line in f:
-                w.write(line)    
-            w.close()
-        elif self.connection_mode == "FTP":
+            if dirname not in self._mkdir_cache:
+                os.makedirs(dirname, exist_ok=True)
+                self._mkdir_cache.add(dirname)
+            with open(path, "wb") as w, open(source_file, "rb") as f:
+                # let the kernel copy the file where possible, rather than
+                # reading it through python
+                try:
+                    size = os.fstat(f.fileno()).st_size
+                    offset = 0
+                    while offset < size:
+                        sent = os.sendfile(w.fileno(), f.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                except (AttributeError, OSError):
+                    f.seek(0)
+                    w.seek(0)
+                    w.truncate()
+                    shutil.copyfileobj(f, w, 1024 * 1024)
+        elif self.connection_mode in self.FTP_MODES:
             stream = io.open(source_file, "rb")
             path = os.path.join(self.path, os.path.dirname(filename))
             basename = os.path.basename(filename)
-            try:
-                self.handle.cwd(path)
-            except IOError:
-                self.handle.mkd(path)
-                self.handle.cwd(path)
-            self.handle.storbinary('STOR ' + basename, stream)
+            self._cwd_or_mkd(path)
+            self.handle.storbinary('STOR ' + basename, stream,
+                                   blocksize=self.UPLOAD_BLOCKSIZE)
             stream.close()
             
     def rename_file(self, oldname, newname):
+        self.rename_many([(oldname, newname)])
+    
+    # Rename several (oldname, newname) pairs, relative to the target directory
+    def rename_many(self, renames):
+        if not renames:
+            return
         if self.connection_mode is None:
-            pass
-        elif self.connection_mode == "FTP":
-            self.handle.cwd(self.path)
-            self.handle.rename(oldname, newname)
+            for oldname, newname in renames:
+                os.renames(os.path.join(self.path, oldname),
+                           os.path.join(self.path, newname))
+        elif self.connection_mode in self.FTP_MODES:
+            self._cwd(self.path)
+            for oldname, newname in renames:
+                self.handle.rename(oldname, newname)
             
     def delete_file(self, filename):
         # delete lock file - if exist
@@ -273,52 +524,196 @@ class Directory:
                 path = os.path.join(self.path, filename)
                 if os.path.exists(path):
                     os.remove(path)
-            elif self.connection_mode == "FTP":
+            elif self.connection_mode in self.FTP_MODES:
                 directory = os.path.dirname(filename)
                 basename = os.path.basename(filename)
-                self.handle.cwd(os.path.join(self.path, directory))
+                self._cwd(os.path.join(self.path, directory))
                 self.handle.delete(basename)
     
+    # Delete several files at once. Paths are grouped by directory so each
+    # directory is only changed into once, rather than once per file.
+    def delete_many(self, filenames):
+        if not filenames or not self.check_locked():
+            return
+        if not self.connection_mode:
+            for filename in filenames:
+                path = os.path.join(self.path, filename)
+                if os.path.exists(path):
+                    os.remove(path)
+        elif self.connection_mode in self.FTP_MODES:
+            by_directory = {}
+            for filename in filenames:
+                by_directory.setdefault(os.path.dirname(filename), []).append(
+                    os.path.basename(filename))
+            for directory, basenames in by_directory.items():
+                self._cwd(os.path.join(self.path, directory))
+                for basename in basenames:
+                    self.handle.voidcmd("DELE " + basename)
+    
+    # Closes the connection (if any) to the destination directory
+    def close(self):
+        if self.connection_mode is None or self.handle is None:
+            return
+        elif self.connection_mode in self.FTP_MODES:
+            try:
+                self.handle.quit()
+            except all_errors:
+                # the server has gone away, just drop our end
+                self.handle.close()
+            self.handle = None
+    
     def abort(self):
-        self.delete_file(self.LOCK_FILE)
+        self.unlock()
         # if we have a connection, close it.
-        if self.connection_mode is None:
+        self.close()
+    
+    # Copies a list of (filename, source_file) pairs into this directory. For remote
+    # targets the files are shared between config.concurrency connections.
+    def copy_many(self, files, config):
+        num_workers = min(config.concurrency, len(files))
+        if self.connection_mode is None or num_workers <= 1:
+            for filename, source_file in files:
+                self.copy_file(filename, source_file)
             return
-        elif self.connection_mode == "FTP":
-            self.handle.quit()
+        
+        # create any new directories first on the main connection, so the extra
+        # connections don't all try to make the same ones at once
+        for dirname in sorted(set(os.path.dirname(filename) for filename, _ in files)):
+            self._cwd_or_mkd(os.path.join(self.path, dirname))
+
+        # Each connection takes the next file as soon as its last upload is done,
+        # so a few large files don't hold up everything queued behind them.
+        pending = queue.Queue()
+        for item in files:
+            pending.put(item)
+        
+        # Extra connections that fail part way hand their file back and drop out,
+        # leaving the rest to the connections that are still up. A failure on
+        # the main connection fails the deploy.
+        def _drain(target, is_extra):
+            while True:
+                try:
+                    filename, source_file = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    target.copy_file(filename, source_file)
+                except all_errors as e:
+                    if not is_extra:
+                        raise
+                    pending.put((filename, source_file))
+                    print ("Extra connection to " + self.path + " failed, continuing without it: " +
+                           (str(e) or e.__class__.__name__))
+                    return
+        
+        def _run_worker():
+            try:
+                worker = self._spawn_worker()
+            except all_errors as e:
+                # e.g. the server limits connections per client. The connections
+                # that did open will share the files between them.
+                print ("Unable to open extra connection to " + self.path + ": " + str(e))
+                return
+            try:
+                _drain(worker, True)
+            finally:
+                worker.close()
+        
+        # the main connection uploads too, so only num_workers - 1 extra are opened
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_run_worker) for _ in range(num_workers - 1)]
+            futures.append(executor.submit(_drain, self, False))
+            for future in futures:
+                future.result()
+        # anything handed back after the main connection finished is uploaded now
+        _drain(self, False)
     
+    # Deploys the fields of `git diff-tree -r --name-status -M -z` output, e.g.
+    # ["M", "path", "R087", "old_path", "new_path"]
     def deploy_diff(self, diff, config):
-        for item in diff:
+        # sort the diff into deletes, renames and copies first so each can be
+        # done in bulk. Deletes and renames stay on the main connection.
+        to_delete = []
+        to_rename = []
+        to_copy = []
+        # local source files all live under the repo path, build that prefix once
+        base = os.path.join(config.path, "")
+        fields = iter(diff)
+        for status in fields:
             # delete all files that have been removed (exist in that commit and not local commit)
-            if item.deleted_file:
-                self.delete_file(str(item.a_path))
+            if status[0] == "D":
+                to_delete.append(next(fields))
             # if the item has been renamed, do that
-            elif item.rename_from and item.rename_to:
-                self.rename_file(str(item.rename_from), 
-                                 str(item.rename_to))
+            elif status[0] == "R":
+                oldname = next(fields)
+                newname = next(fields)
+                to_rename.append((oldname, newname))
+                # a rename with changes still needs the new contents uploading
+                if status != "R100":
+                    to_copy.append((newname, base + newname))
+            elif status[0] == "C":
+                next(fields)
+                newname = next(fields)
+                to_copy.append((newname, base + newname))
             else:
                 # copy over all files that have been added or changed    
-                self.copy_file(str(item.a_path), 
-                                    str(os.path.join(config.path, item.a_path)))
+                path = next(fields)
+                to_copy.append((path, base + path))
+        
+        self.delete_many(to_delete)
+        self.rename_many(to_rename)
+        self.copy_many(to_copy, config)
+    
+    # Uploads the tree as a single archive and asks the server to unpack it.
+    # Returns False if the server refused, so the files can be sent one by one.
+    def _deploy_tree_archive(self, tree, config):
+        base = os.path.join(config.path, "")
+        archive = tempfile.NamedTemporaryFile(suffix=".tar", delete=False)
+        try:
+            with tarfile.open(fileobj=archive, mode="w") as tar:
+                for path in tree:
+                    tar.add(base + path, arcname=path, recursive=False)
+            archive.close()
+            self.copy_file(self.DEPLOY_ARCHIVE, archive.name)
+        finally:
+            archive.close()
+            os.remove(archive.name)
+        
+        try:
+            self._cwd(self.path)
+            self.handle.voidcmd("SITE EXEC tar -xf " + self.DEPLOY_ARCHIVE)
+            extracted = True
+        except error_perm as e:
+            print ("Unable to unpack archive on server: " + str(e))
+            extracted = False
+        self.delete_many([self.DEPLOY_ARCHIVE])
+        return extracted
     
     # Instead of deploying a diff, deploy everything in the tree.
     def deploy_tree(self, tree, config):
-        for path in tree:
-            self.copy_file(str(path), str(os.path.join(config.path, path)))
+        if self.connection_mode in self.FTP_MODES and self.remote_untar:
+            if self._deploy_tree_archive(tree, config):
+                return
+        base = os.path.join(config.path, "")
+        self.copy_many([(path, base + path) for path in tree], config)
         
     def deploy(self, commit, config):
-        # diff between commit id and local repo's last pushed commit
+        # diff between commit id and local repo's last pushed commit.
+        # Asking git directly is much faster than walking the trees in gitpython.
+        # Paths are NUL separated (-z) so any legal filename comes through as is
+        g = Git( config.path )
         if self.commit is not None:
-            diff = self.commit.diff(commit)
-            self.deploy_diff(diff, config)
+            diff = g.diff_tree("-r", "--name-status", "-M", "-z",
+                               self.commit.hexsha, commit.hexsha)
+            self.deploy_diff(split_nul(diff), config)
         else:
-            g = Git( config.path )
-            self.deploy_tree(g.ls_files().split("\n"), config)
+            tree = g.ls_tree("-r", "--name-only", "-z", commit.hexsha)
+            self.deploy_tree(split_nul(tree), config)
         
         # update .commit file in target target_dir
         self.write_new_file(self.COMMIT_FILE, commit.hexsha)
         # delete lock file
-        self.delete_file(self.LOCK_FILE)
+        self.unlock()
         return True
     
 if __name__ == "__main__":
@@ -335,7 +730,7 @@ if __name__ == "__main__":
     try :
         config = Config_Details("git_deploy.config")
     except IOError as e:
-        print (e.message)
+        print (str(e))
         print ("Unable to read git_deply.config. Aborting.")
         exit()
     
@@ -354,7 +749,7 @@ if __name__ == "__main__":
     
     # either we have the commit specified or we use the head
     if commit_id is not None:
-        commit = repo.commit(commit_id)
+        commit = resolve_commit(repo, commit_id)
     else:
         commit = repo.head.commit
     
@@ -367,9 +762,31 @@ if __name__ == "__main__":
         if not check_dirs_configured(config, locked_dirs, repo):
             exit()
             
-    # for each target target_dir - get a diff between commit and local git Repo
-    for target_dir in config.dirs:
-        if target_dir.deploy(commit, config):
-            print "Deployed successfully to ", str(target_dir.path)
+    # deploy to a single target_dir. A failure shouldn't stop the other
+    # deploys, but the failed directory still needs unlocking
+    def _deploy(target_dir):
+        try:
+            return target_dir.deploy(commit, config)
+        except Exception as e:
+            print ("Deploy to " + target_dir.path + " failed: " + str(e))
+            try:
+                target_dir.abort()
+            except Exception as e:
+                print ("Unable to unlock " + target_dir.path + ": " + str(e))
+            return False
+    
+    try:
+        # for each target target_dir - get a diff between commit and local git Repo.
+        # Deploys to separate directories are independent, so run them in parallel
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_TARGET_THREADS, len(config.dirs)))) as executor:
+            deployed = list(executor.map(_deploy, config.dirs))
+
+        for target_dir, success in zip(config.dirs, deployed):
+            if success:
+                print ("Deployed successfully to", target_dir.path)
+    finally:
+        # connections are kept open through every phase, close them once at the end
+        for target_dir in config.dirs:
+            target_dir.close()
             
     print ("Done")
\ No newline at end of file